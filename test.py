@@ -1,9 +1,12 @@
 #!/usr/bin/env python3.5
 
+import base64
+import io
 import json
 import re
 import subprocess
 import unittest
+import zipfile
 from urllib.request import Request, urlopen
 
 html_data = '''
@@ -19,6 +22,22 @@ html_data = '''
 '''
 
 
+def multipart_factory(path, files):
+    boundary = 'docker-weasyprint-test'
+    body = b''
+    for field, content in files.items():
+        body += ('--%s\r\n'
+                 'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n' % (boundary, field, field)).encode('utf-8')
+        body += content + b'\r\n'
+    body += ('--%s--\r\n' % boundary).encode('utf-8')
+    url = 'http://127.0.0.1:5001%s' % path
+    headers = {
+        'Content-Type': 'multipart/form-data; boundary=%s' % boundary
+    }
+    return Request(url, data=body, headers=headers, method='POST')
+
+
 def request_factory(path='/'):
     url = 'http://127.0.0.1:5001%s' % path
     headers = {
@@ -27,6 +46,25 @@ def request_factory(path='/'):
     return Request(url, data=html_data.encode('utf-8'), headers=headers, method='POST')
 
 
+class TestHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.response = urlopen('http://127.0.0.1:5001/health')
+
+    def tearDown(self):
+        self.response.close()
+
+    def test_response_code(self):
+        self.assertEqual(self.response.getcode(), 200)
+
+    def test_headers(self):
+        headers = dict(self.response.info())
+        self.assertTrue(headers['Content-Type'].startswith('text/plain'))
+
+    def test_body(self):
+        self.assertEqual(self.response.read(), b'ok')
+
+
 class TestPdf(unittest.TestCase):
 
     def setUp(self):
@@ -48,6 +86,30 @@ class TestPdf(unittest.TestCase):
         self.assertEqual(self.response.read()[:4], b'%PDF')
 
 
+class TestPdfMultipart(unittest.TestCase):
+
+    def setUp(self):
+        request = multipart_factory('/pdf?filename=sample.pdf', {
+            'html': html_data.encode('utf-8'),
+            'css': b'h1 { color: red; }',
+        })
+        self.response = urlopen(request)
+
+    def tearDown(self):
+        self.response.close()
+
+    def test_response_code(self):
+        self.assertEqual(self.response.getcode(), 200)
+
+    def test_headers(self):
+        headers = dict(self.response.info())
+        self.assertEqual(headers['Content-Type'], 'application/pdf')
+        self.assertEqual(headers['Content-Disposition'], 'inline;filename=sample.pdf')
+
+    def test_body(self):
+        self.assertEqual(self.response.read()[:4], b'%PDF')
+
+
 class TestMultiple(unittest.TestCase):
 
     def setUp(self):
@@ -76,5 +138,39 @@ class TestMultiple(unittest.TestCase):
         self.assertEqual(len(pages), 2)
 
 
+class TestZip(unittest.TestCase):
+
+    def setUp(self):
+        url = 'http://127.0.0.1:5001/zip?filename=sample.zip'
+        headers = {
+            'Content-Type': 'application/json'
+        }
+        encoded_html = base64.b64encode(html_data.encode('utf-8')).decode('ascii')
+        data = json.dumps({
+            'htmls': [encoded_html, encoded_html],
+            'css': base64.b64encode(b'h1 { color: red; }').decode('ascii'),
+            'filenames': ['first.pdf', 'second.pdf'],
+            'user_passwords': ['', 'secret'],
+        }).encode('utf-8')
+        request = Request(url, data=data, headers=headers, method='POST')
+        self.response = urlopen(request)
+
+    def tearDown(self):
+        self.response.close()
+
+    def test_response_code(self):
+        self.assertEqual(self.response.getcode(), 200)
+
+    def test_headers(self):
+        headers = dict(self.response.info())
+        self.assertEqual(headers['Content-Type'], 'application/zip')
+        self.assertEqual(headers['Content-Disposition'], 'inline;filename=sample.zip')
+
+    def test_body(self):
+        with zipfile.ZipFile(io.BytesIO(self.response.read())) as archive:
+            self.assertEqual(archive.namelist(), ['first.pdf', 'second.pdf'])
+            self.assertEqual(archive.read('first.pdf')[:4], b'%PDF')
+
+
 if __name__ == '__main__':
     unittest.main()
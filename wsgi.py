@@ -1,29 +1,264 @@
 #!/usr/bin/env python
 
-import json
-import os, io, zipfile
+import atexit
+import collections
+import contextlib
+import hashlib
+import hmac
+import os, io
 import logging
-from functools import wraps
+import multiprocessing
+import shutil
+import socket
+from functools import lru_cache, wraps
 import urllib.request
-import base64
+import binascii
 import subprocess
-
-from pypdf import PdfReader, PdfWriter
-from flask import Flask, request, make_response, abort
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import orjson
+import pikepdf
+from flask import Flask, Response, request, abort, stream_with_context
 from weasyprint import HTML, CSS
 from weasyprint.text.fonts import FontConfiguration
+from zipstream import ZipStream
 
 # Process-lifetime font cache. Do NOT delete /tmp/weasyprint-* between requests —
 # FontConfiguration keeps paths into that tree and bulk /zip fails with FileNotFoundError.
 font_config = FontConfiguration()
 
+# Prime fontconfig, Pango and the hyphenation tables at import. Under gunicorn --preload
+# this runs once in the master and the workers share the result copy-on-write.
+HTML(string='<html><body style="font-family:sans-serif">x</body></html>').write_pdf(font_config=font_config)
+
+# Long-lived LibreOffice listener for /xlsx, so each conversion connects to a running
+# office instead of paying the soffice cold start. Only the xlsx image ships unoconv.
+# Render pool processes import this module too; only the serving process starts it.
+UNOCONV_PORT = 2002
+unoconv_listener = None
+unoconv_listener_pid = None
+
+
+def start_unoconv_listener():
+    global unoconv_listener, unoconv_listener_pid
+    unoconv_listener = subprocess.Popen(['unoconv', '--listener', '--port', str(UNOCONV_PORT)])
+    unoconv_listener_pid = os.getpid()
+
+
+if shutil.which('unoconv') and multiprocessing.parent_process() is None:
+    start_unoconv_listener()
+
+    @atexit.register
+    def stop_unoconv_listener():
+        # Preloaded gunicorn workers inherit this hook; only the starting process stops it.
+        if os.getpid() == unoconv_listener_pid:
+            unoconv_listener.terminate()
+
+
+# Optional process pool for the multi-document routes. WeasyPrint is not thread-safe,
+# so renders fan out to processes. Off by default: every pool process carries its own
+# Cairo/Pango state, which does not fit the single-worker RSS budget in the Dockerfile.
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', '0'))
+render_pool = None
+
+# Opt-in cache of recently rendered /pdf output keyed by a digest of the html and css,
+# so repeated payloads skip WeasyPrint. Holds unencrypted bytes only; passwords are
+# applied per request. Off by default: resources fetched by URL during the render are
+# not part of the key, and every entry counts against the single-worker RSS budget.
+PDF_CACHE_SIZE = int(os.environ.get('PDF_CACHE_SIZE', '0'))
+pdf_cache = collections.OrderedDict()
+pdf_cache_lock = threading.Lock()
+
+# Read once at import; requests that send X_API_KEY must match it.
+API_KEY = os.environ.get('X_API_KEY')
+if API_KEY is not None:
+    API_KEY = API_KEY.encode()
+
 app = Flask('pdf')
 
 
+def get_render_pool():
+    global render_pool
+    if render_pool is None and RENDER_WORKERS > 0:
+        # forkserver processes start from a clean server rather than forking this worker,
+        # so they do not inherit the client socket of the request that (re)builds the pool
+        render_pool = ProcessPoolExecutor(
+            max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+    return render_pool
+
+
+def discard_render_pool(pool):
+    # A render process that died (OOM kill, Cairo crash) breaks the whole executor; drop
+    # it so the next request builds a fresh one.
+    global render_pool
+    if render_pool is pool:
+        render_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def unoconv_listener_ready(timeout=30):
+    # Restart the listener if it has exited (poll() also reaps it), then wait until its
+    # office accepts connections, so a conversion never races it for the port. Preloaded
+    # workers did not start the listener and can only probe it.
+    if unoconv_listener is None:
+        return False
+    if os.getpid() == unoconv_listener_pid and unoconv_listener.poll() is not None:
+        app.logger.error('unoconv listener exited with status %s; restarting it', unoconv_listener.returncode)
+        start_unoconv_listener()
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', UNOCONV_PORT), timeout=1):
+                return True
+        except OSError:
+            if time.monotonic() >= deadline:
+                app.logger.warning('unoconv listener is not accepting on port %s; converting without it', UNOCONV_PORT)
+                return False
+            time.sleep(0.25)
+
+
+def parse_stylesheets(css):
+    return [CSS(string=css, font_config=font_config)] if css else []
+
+
+def render_pdf(html, stylesheets=()):
+    return HTML(string=html).write_pdf(stylesheets=stylesheets, font_config=font_config)
+
+
+@lru_cache(maxsize=1)
+def get_pool_stylesheets(css):
+    # Only used inside render pool processes, which receive the CSS as bytes: each
+    # process parses a request's CSS once and keeps just the latest one.
+    return parse_stylesheets(css)
+
+
+def pool_render_pdf(html, css=None):
+    # Returns bytes rather than a Document so results can cross the process pool.
+    return render_pdf(html, get_pool_stylesheets(css))
+
+
+def cached_render(html, css):
+    if PDF_CACHE_SIZE <= 0:
+        return render_pdf(html, parse_stylesheets(css))
+
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(len(html).to_bytes(8, 'big'))
+    digest.update(html)
+    digest.update(css)
+    key = digest.digest()
+
+    with pdf_cache_lock:
+        if key in pdf_cache:
+            pdf_cache.move_to_end(key)
+            return pdf_cache[key]
+
+    pdf = render_pdf(html, parse_stylesheets(css))
+    with pdf_cache_lock:
+        pdf_cache[key] = pdf
+        while len(pdf_cache) > PDF_CACHE_SIZE:
+            pdf_cache.popitem(last=False)
+    return pdf
+
+
+def pooled_renders(pool, htmls, css=None):
+    # Keep at most RENDER_WORKERS renders in flight, so finished PDFs do not pile up
+    # ahead of a slow consumer such as the /zip stream.
+    remaining = collections.deque(htmls)
+    pending = collections.deque()
+    try:
+        while remaining or pending:
+            while remaining and len(pending) < RENDER_WORKERS:
+                pending.append((remaining[0], pool.submit(pool_render_pdf, remaining[0], css)))
+                remaining.popleft()
+            pdf = pending[0][1].result()
+            pending.popleft()
+            yield pdf
+    except BrokenProcessPool:
+        app.logger.exception('Render pool broke; rebuilding it and rendering the rest in process')
+        discard_render_pool(pool)
+        stylesheets = parse_stylesheets(css)
+        for html in [html for html, future in pending] + list(remaining):
+            yield render_pdf(html, stylesheets)
+
+
+def render_all(htmls, css=None):
+    pool = get_render_pool()
+    if pool is None:
+        # parsed once per request and shared by every document in it
+        stylesheets = parse_stylesheets(css)
+        return (render_pdf(html, stylesheets) for html in htmls)
+    return pooled_renders(pool, htmls, css)
+
+
+def get_encryption(user_password, owner_password=None):
+    return pikepdf.Encryption(user=user_password, owner=owner_password or user_password, R=6)
+
+
+def encrypt_pdf(pdf, encryption):
+    # WeasyPrint cannot encrypt while writing, so this is the one post-pass every route shares.
+    with pikepdf.open(io.BytesIO(pdf)) as document, io.BytesIO() as f:
+        document.save(f, encryption=encryption)
+        return f.getvalue()
+
+
+def zip_entry(pdfs, filename, encryption=None):
+    # ZipStream reads entries in the order they were added, so each entry takes the
+    # next rendered pdf only once the archive has been streamed up to it.
+    pdf = next(pdfs)
+    app.logger.info('Filename %s', filename)
+    if encryption:
+        pdf = encrypt_pdf(pdf, encryption)
+    yield pdf
+
+
+def stream_archive(archive, name):
+    # Documents render while the body streams, after the 200 has gone out, so failures
+    # can only be logged here; the client sees a truncated archive.
+    try:
+        yield from archive
+    except Exception:
+        app.logger.exception(' ==> POST  /zip?filename=%s  failed while streaming', name)
+        raise
+    app.logger.info(' ==> POST  /zip?filename=%s  ok', name)
+
+
+def binary_response(data, filename, mimetype):
+    # The shared header block for the single-document routes.
+    response = Response(data, mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'inline;filename=%s' % filename
+    return response
+
+
+def read_payload(*fields):
+    # multipart/form-data uploads carry the payloads as raw files and the options as form
+    # fields, skipping JSON escaping and base64; JSON bodies carry base64 encoded payloads.
+    if request.headers['Content-Type'].startswith('multipart/'):
+        return [request.files[field].read() for field in fields], request.form
+    data = orjson.loads(request.data)
+    return [binascii.a2b_base64(data[field]) for field in fields], data
+
+
+def json_list(value):
+    # Lists are sent as JSON arrays; older clients still send them JSON encoded in a string.
+    return orjson.loads(value) if isinstance(value, str) else value
+
+
+def is_payload_request():
+    content_type = request.headers['Content-Type']
+    return content_type == 'application/json' or content_type.startswith('multipart/')
+
+
 def authenticate(f):
     @wraps(f)
     def checkauth(*args, **kwargs):
-        if 'X_API_KEY' not in request.headers or os.environ.get('X_API_KEY') == request.headers['X_API_KEY']:
+        sent = request.headers.get('X_API_KEY')
+        if sent is None or (API_KEY is not None and hmac.compare_digest(sent.encode(), API_KEY)):
             return f(*args, **kwargs)
         else:
             abort(401)
@@ -38,17 +273,23 @@ def auth():
         abort(401)
 
 
+# Static bodies are built once; the handlers only wrap them in a fresh Response.
+HEALTH_BODY = b'ok'
+
+
 @app.route('/health')
 def index():
-    return 'ok'
+    return Response(HEALTH_BODY, mimetype='text/plain')
 
 
 @app.before_first_request
 def setup_logging():
-    logging.addLevelName(logging.DEBUG, "\033[1;36m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
-    logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
-    logging.addLevelName(logging.WARNING, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
-    logging.addLevelName(logging.ERROR, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
+    # Colour level names only for a terminal; log collectors would store the escapes verbatim.
+    if sys.stderr.isatty():
+        logging.addLevelName(logging.DEBUG, "\033[1;36m%s\033[1;0m" % logging.getLevelName(logging.DEBUG))
+        logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
+        logging.addLevelName(logging.WARNING, "\033[1;33m%s\033[1;0m" % logging.getLevelName(logging.WARNING))
+        logging.addLevelName(logging.ERROR, "\033[1;31m%s\033[1;0m" % logging.getLevelName(logging.ERROR))
 
     handler = logging.StreamHandler()
     handler.setFormatter(logging.Formatter(
@@ -56,19 +297,23 @@ def setup_logging():
         '[in %(pathname)s:%(lineno)d]'
     ))
     app.logger.addHandler(handler)
-    app.logger.setLevel(logging.DEBUG)
+    app.logger.setLevel(logging.INFO)
 
 
-@app.route('/')
-def home():
-    return '''
+HOME_PAGE = b'''
             <h1>PDF Generator</h1>
             <p>The following endpoints are available:</p>
             <ul>
                 <li>POST to <code>/pdf?filename=myfile.pdf</code>. The body should
                     contain html or a JSON list of html strings and css strings: { "html": base64_encoded(html), "css": base64_encoded(css) }</li>
-                <li>POST to <code>/zip?filename=myfile.pdf</code>. The body should
-                    contain html or a JSON list of html strings and css strings: { "html": base64_encoded(html), "css": base64_encoded(css) }</li>
+                <li>POST to <code>/xlsx?filename=myfile.pdf</code>. The body should
+                    contain a JSON object: { "xlsx": base64_encoded(xlsx) }</li>
+                <li><code>/pdf</code> and <code>/xlsx</code> also accept <code>multipart/form-data</code>
+                    with the html/css or xlsx payloads as raw file uploads and the passwords as form fields</li>
+                <li>POST to <code>/zip?filename=myfile.zip</code>. The body should
+                    contain a JSON object: { "htmls": [base64_encoded(html), ...], "css": base64_encoded(css),
+                    "filenames": ["a.pdf", ...], "user_passwords": ["secret", ...], "owner_password": "owner" }.
+                    Each html is rendered to the matching filename in the zip</li>
                 <li>POST to <code>/multiple?filename=myfile.pdf</code>. The body
                     should contain a JSON list of html strings. They will each
                     be rendered and combined into a single pdf</li>
@@ -76,152 +321,128 @@ def home():
         '''
 
 
+@app.route('/')
+def home():
+    return Response(HOME_PAGE, mimetype='text/html')
+
+
 @app.route('/pdf', methods=['POST'])
 @authenticate
 def generate():
     name = request.args.get('filename', 'unnamed.pdf')
-    app.logger.info('POST  /pdf?filename=%s' % name)
-    app.logger.info('Content-Type %s' % request.headers['Content-Type'])
+    app.logger.info('POST  /pdf?filename=%s', name)
+    app.logger.debug('Content-Type %s', request.headers['Content-Type'])
 
-    if request.headers['Content-Type'] == 'application/json':
-        data = json.loads(request.data.decode('utf-8'))
+    if is_payload_request():
+        (html, css), data = read_payload('html', 'css')
 
-        html = HTML(string=base64.b64decode(data['html']))
-        css = CSS(string=base64.b64decode(data['css']), font_config=font_config)
         user_password = data.get('user_password')
         owner_password = data.get('owner_password')
 
-        pdf = html.write_pdf(stylesheets=[css], font_config=font_config)
+        pdf = cached_render(html, css)
 
         if user_password:
-            reader = PdfReader(io.BytesIO(pdf))
-            writer = PdfWriter()
-            for page in reader.pages:
-                writer.add_page(page)
-            writer.encrypt(user_password, owner_password=owner_password)
-
-            with io.BytesIO() as f:
-                writer.write(f)
-                pdf = f.getvalue()
-
-    response = make_response(pdf)
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = 'inline;filename=%s' % name
-    app.logger.info(' ==> POST  /pdf?filename=%s  ok' % name)
-    return response
+            pdf = encrypt_pdf(pdf, get_encryption(user_password, owner_password))
+
+    app.logger.info(' ==> POST  /pdf?filename=%s  ok', name)
+    return binary_response(pdf, name, 'application/pdf')
 
 # create route to accept input as xlsx file and use unoconv to convert to pdf
 @app.route('/xlsx', methods=['POST'])
 @authenticate
 def xlsx():
     name = request.args.get('filename', 'unnamed.pdf')
-    app.logger.info('POST  /xlsx?filename=%s' % name)
-    app.logger.info('Content-Type %s' % request.headers['Content-Type'])
-
-    if request.headers['Content-Type'] == 'application/json':
-        data = json.loads(request.data.decode('utf-8'))
+    app.logger.info('POST  /xlsx?filename=%s', name)
+    app.logger.debug('Content-Type %s', request.headers['Content-Type'])
 
-        # write xlsx file to disk
-        with open('input.xlsx', 'wb') as f:
-            f.write(base64.b64decode(data['xlsx']))
+    if is_payload_request():
+        (spreadsheet,), data = read_payload('xlsx')
 
         user_password = data.get('user_password')
 
-        # convert xlsx to pdf
-        command = ['unoconv', '-f', 'pdf']
-        if user_password:
-            command.extend(['--export=EncryptFile=true', '--export=DocumentOpenPassword=' + user_password])
-        command.append('input.xlsx')
-        subprocess.call(command)
-
-        # read pdf file from disk
-        with open('input.pdf', 'rb') as f:
-            pdf = f.read()
-
-        # remove xlsx and pdf files from disk
-        if os.path.exists('input.xlsx'):
-            os.remove('input.xlsx')
-        if os.path.exists('input.pdf'):
-            os.remove('input.pdf')
-
-    response = make_response(pdf)
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = 'inline;filename=%s' % name
-    app.logger.info(' ==> POST  /xlsx?filename=%s  ok' % name)
-    return response
+        # convert xlsx to pdf in a per-request directory so concurrent requests never share
+        # file names, reusing the listener's office instance when it is up
+        with tempfile.TemporaryDirectory() as workdir:
+            source = os.path.join(workdir, 'input.xlsx')
+            with open(source, 'wb') as f:
+                f.write(spreadsheet)
+
+            command = ['unoconv', '-f', 'pdf', '--port', str(UNOCONV_PORT)]
+            if unoconv_listener_ready():
+                # fail rather than start a second office if the listener goes away mid-request
+                command.append('--no-launch')
+            if user_password:
+                command.extend(['--export=EncryptFile=true', '--export=DocumentOpenPassword=' + user_password])
+            command.append(source)
+            try:
+                subprocess.run(command, stderr=subprocess.PIPE, check=True)
+            except subprocess.CalledProcessError as e:
+                app.logger.error('unoconv failed for %s: %s', name, e.stderr.decode('utf-8', 'replace'))
+                abort(500)
+
+            with open(os.path.join(workdir, 'input.pdf'), 'rb') as f:
+                pdf = f.read()
+
+    app.logger.info(' ==> POST  /xlsx?filename=%s  ok', name)
+    return binary_response(pdf, name, 'application/pdf')
 
 @app.route('/zip', methods=['POST'])
 @authenticate
 def zip():
     name = request.args.get('filename', 'unnamed.zip')
-    app.logger.info('POST  /zip?filename=%s' % name)
-    app.logger.info('Content-Type %s' % request.headers['Content-Type'])
-    fileobj = io.BytesIO()
+    app.logger.info('POST  /zip?filename=%s', name)
+    app.logger.debug('Content-Type %s', request.headers['Content-Type'])
+    archive = ZipStream()
 
     if request.headers['Content-Type'] == 'application/json':
-        data = json.loads(request.data.decode('utf-8'))
+        data = orjson.loads(request.data)
 
-        htmls = json.loads(data['htmls'])
-        css = CSS(string=base64.b64decode(data['css']), font_config=font_config)
-        filenames = json.loads(data['filenames'])
-        user_passwords = json.loads(data.get('user_passwords', '[]'))
+        htmls = json_list(data['htmls'])
+        css = binascii.a2b_base64(data['css'])
+        filenames = json_list(data['filenames'])
+        user_passwords = json_list(data.get('user_passwords', []))
         owner_password = data.get('owner_password', '')
 
-        with zipfile.ZipFile(fileobj, mode="w") as archive:
-            for index in range(len(filenames)):
-                app.logger.info('Filename %s' % filenames[index])
-                html = HTML(string=base64.b64decode(htmls[index]))
-                html.write_pdf(filenames[index], stylesheets=[css], font_config=font_config)
-
-                if user_passwords and index < len(user_passwords) and user_passwords[index]:
-                    reader = PdfReader(filenames[index])
-                    writer = PdfWriter()
-                    for page in reader.pages:
-                        writer.add_page(page)
-
-                    writer.encrypt(user_passwords[index], owner_password=owner_password)
-                    with open(filenames[index], 'wb') as f:
-                        writer.write(f)
-
-                archive.write(filenames[index])
+        decoded_htmls = [binascii.a2b_base64(html) for html in htmls[:len(filenames)]]
+        pdfs = iter(render_all(decoded_htmls, css))
 
-                if os.path.exists(filenames[index]):
-                    os.remove(filenames[index])
+        for index, filename in enumerate(filenames[:len(decoded_htmls)]):
+            user_password = user_passwords[index] if index < len(user_passwords) else None
+            encryption = get_encryption(user_password, owner_password) if user_password else None
+            archive.add(zip_entry(pdfs, filename, encryption), filename)
 
-    response = make_response(fileobj.getvalue())
-    response.headers['Content-Type'] = 'application/zip'
+    response = Response(stream_with_context(stream_archive(archive, name)), mimetype='application/zip')
     response.headers['Content-Disposition'] = 'inline;filename=%s' % name
-    app.logger.info(' ==> POST  /zip?filename=%s  ok' % name)
     return response
 
 @app.route('/multiple', methods=['POST'])
 @authenticate
 def multiple():
     name = request.args.get('filename', 'unnamed.pdf')
-    app.logger.info('POST  /multiple?filename=%s' % name)
-    data = json.loads(request.data.decode('utf-8'))
+    app.logger.info('POST  /multiple?filename=%s', name)
+    data = orjson.loads(request.data)
     htmls = data['htmls']
     user_password = data.get('user_password')
     owner_password = data.get('owner_password')
-    documents = [HTML(string=html).render() for html in htmls]
-    pdf = documents[0].copy([page for doc in documents for page in doc.pages]).write_pdf()
-
-    if user_password:
-        reader = PdfReader(io.BytesIO(pdf))
-        writer = PdfWriter()
-        for page in reader.pages:
-            writer.add_page(page)
-        writer.encrypt(user_password, owner_password=owner_password)
-
-        with io.BytesIO() as f:
-            writer.write(f)
-            pdf = f.getvalue()
-    response = make_response(pdf)
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = 'inline;filename=%s' % name
-    app.logger.info(' ==> POST  /multiple?filename=%s  ok' % name)
-    return response
 
+    if not htmls:
+        abort(400)
 
-if __name__ == '__main__':
-    app.run()
+    pdfs = list(render_all(htmls))
+    encryption = get_encryption(user_password, owner_password) if user_password else None
+
+    if len(pdfs) == 1:
+        # nothing to merge, so the rendered document goes out without a second save
+        pdf = pdfs[0]
+        if encryption:
+            pdf = encrypt_pdf(pdf, encryption)
+    else:
+        # the source documents must stay open until the merged copy is saved
+        with contextlib.ExitStack() as stack, io.BytesIO() as f:
+            merged = stack.enter_context(pikepdf.Pdf.new())
+            for pdf in pdfs:
+                merged.pages.extend(stack.enter_context(pikepdf.open(io.BytesIO(pdf))).pages)
+            merged.save(f, encryption=encryption)
+            pdf = f.getvalue()
+    app.logger.info(' ==> POST  /multiple?filename=%s  ok', name)
+    return binary_response(pdf, name, 'application/pdf')